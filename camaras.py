@@ -1,7 +1,8 @@
+import time
+PROCESS_START = time.time()
 import subprocess
 import os
 import threading
-import time
 import signal
 import sys
 import json
@@ -9,18 +10,92 @@ import uuid
 from datetime import datetime
 from dotenv import load_dotenv
 import numpy as np
-from ultralytics import YOLO
 from collections import deque
 import queue
 import tempfile
-import tkinter as tk
-from tkinter import Canvas
-from PIL import Image, ImageTk, ImageDraw, ImageFont
+import socket
+import urllib.request
+import io
+import re
+import glob
+import shutil
+import importlib.util
+import cProfile
+import pstats
+import hashlib
+import base64
+import struct
+from concurrent.futures import ThreadPoolExecutor, Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image, ImageDraw, ImageFont
 import logging
 logging.getLogger('ultralytics').setLevel(logging.ERROR)
 
 load_dotenv()
 
+# Módulos de GUI: se importan sólo si se muestran ventanas (no en VPS_MODE)
+tk = None
+ImageTk = None
+
+def import_gui():
+    """Importar tkinter y PIL.ImageTk bajo demanda"""
+    global tk, ImageTk
+    if tk is None:
+        import tkinter
+        from PIL import ImageTk as pil_image_tk
+        tk = tkinter
+        ImageTk = pil_image_tk
+
+class StartupTimer:
+    """Medir duración de cada fase del arranque"""
+    def __init__(self, start_time=PROCESS_START):
+        self.start_time = start_time
+        self.phases = {}
+        self.milestones = {}
+        self.lock = threading.Lock()
+        self.reported = False
+    
+    def record(self, name, duration):
+        with self.lock:
+            self.phases[name] = duration
+        print(f"[arranque] {name}: {duration:.2f}s")
+    
+    def phase(self, name):
+        """Context manager que registra la duración de una fase"""
+        timer = self
+        
+        class _Phase:
+            def __enter__(self):
+                self.start = time.time()
+            
+            def __exit__(self, *exc):
+                timer.record(name, time.time() - self.start)
+        
+        return _Phase()
+    
+    def milestone(self, name):
+        """Registrar (una sola vez) el tiempo transcurrido desde el inicio del proceso"""
+        with self.lock:
+            if name in self.milestones:
+                return
+            elapsed = time.time() - self.start_time
+            self.milestones[name] = elapsed
+        print(f"[arranque] {name} a los {elapsed:.2f}s")
+    
+    def report(self):
+        with self.lock:
+            if self.reported:
+                return
+            self.reported = True
+            phases = dict(self.phases)
+            milestones = dict(self.milestones)
+        
+        print("[arranque] Resumen:")
+        for name, duration in phases.items():
+            print(f"  {name:<24} {duration:6.2f}s")
+        for name, elapsed in sorted(milestones.items(), key=lambda item: item[1]):
+            print(f"  {name:<24} +{elapsed:5.2f}s")
+
 class VideoWindow:
     def __init__(self, camera_index, width=640, height=480):
         self.camera_index = camera_index
@@ -28,7 +103,7 @@ class VideoWindow:
         self.root.title(f"Cámara {camera_index}")
         self.root.geometry(f"{width}x{height}")
         
-        self.canvas = Canvas(self.root, width=width, height=height)
+        self.canvas = tk.Canvas(self.root, width=width, height=height)
         self.canvas.pack()
         
         self.current_image = None
@@ -68,6 +143,1666 @@ class VideoWindow:
         except:
             pass
 
+class ZoneFilter:
+    """Zonas de interés (ROI) y de exclusión de una cámara"""
+    def __init__(self, roi_polygons, exclusion_polygons, frame_width, frame_height, padding=16):
+        self.roi_polygons = roi_polygons
+        self.exclusion_polygons = exclusion_polygons
+        self.crop_box = self.compute_crop_box(frame_width, frame_height, padding)
+    
+    @staticmethod
+    def parse_polygons(value):
+        """Parsear polígonos con formato 'x,y;x,y;x,y|x,y;...'"""
+        polygons = []
+        if not value:
+            return polygons
+        
+        for polygon_str in value.split('|'):
+            points = []
+            try:
+                for point_str in polygon_str.split(';'):
+                    point_str = point_str.strip()
+                    if not point_str:
+                        continue
+                    x, y = point_str.split(',')
+                    points.append((int(x.strip()), int(y.strip())))
+            except ValueError as e:
+                print(f"Polígono ignorado (punto no válido): {polygon_str} ({e})")
+                continue
+            if len(points) >= 3:
+                polygons.append(points)
+            elif points:
+                print(f"Polígono ignorado (menos de 3 puntos): {polygon_str}")
+        return polygons
+    
+    @staticmethod
+    def point_in_polygon(x, y, polygon):
+        """Ray casting: True si el punto está dentro del polígono"""
+        inside = False
+        j = len(polygon) - 1
+        for i in range(len(polygon)):
+            xi, yi = polygon[i]
+            xj, yj = polygon[j]
+            if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            j = i
+        return inside
+    
+    def compute_crop_box(self, frame_width, frame_height, padding):
+        """Caja envolvente de todas las ROI, recortada al tamaño del frame"""
+        if not self.roi_polygons:
+            return None
+        
+        xs = [x for polygon in self.roi_polygons for x, _ in polygon]
+        ys = [y for polygon in self.roi_polygons for _, y in polygon]
+        x1 = max(0, min(xs) - padding)
+        y1 = max(0, min(ys) - padding)
+        x2 = min(frame_width, max(xs) + padding)
+        y2 = min(frame_height, max(ys) + padding)
+        
+        if x2 <= x1 or y2 <= y1:
+            return None
+        if (x1, y1, x2, y2) == (0, 0, frame_width, frame_height):
+            return None
+        return (x1, y1, x2, y2)
+    
+    def crop(self, frame_array):
+        """Recortar el frame a la ROI. Devuelve (recorte, offset_x, offset_y)"""
+        if self.crop_box is None:
+            return frame_array, 0, 0
+        x1, y1, x2, y2 = self.crop_box
+        return frame_array[y1:y2, x1:x2], x1, y1
+    
+    def inference_size(self, max_imgsz):
+        """Tamaño de inferencia para el recorte: lado mayor redondeado a múltiplo de 32, sin superar max_imgsz"""
+        if self.crop_box is None:
+            return max_imgsz
+        x1, y1, x2, y2 = self.crop_box
+        long_side = max(x2 - x1, y2 - y1)
+        return min(max_imgsz, -(-long_side // 32) * 32)
+    
+    def accepts(self, detection):
+        """Verificar si la detección cae dentro de la ROI y fuera de las exclusiones"""
+        x, y = detection['center']
+        
+        if self.roi_polygons and not any(self.point_in_polygon(x, y, p) for p in self.roi_polygons):
+            return False
+        if any(self.point_in_polygon(x, y, p) for p in self.exclusion_polygons):
+            return False
+        return True
+
+class WebhookSink:
+    """Enviar lotes de eventos por HTTP POST (JSON)"""
+    def __init__(self, url, timeout=2):
+        self.name = f"webhook:{url}"
+        self.url = url
+        self.timeout = timeout
+    
+    def send(self, batch):
+        body = json.dumps(batch).encode()
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+    
+    def close(self):
+        pass
+
+class UnixSocketSink:
+    """Enviar eventos como líneas JSON por un socket Unix"""
+    def __init__(self, path, timeout=2):
+        self.name = f"unix:{path}"
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+    
+    def send(self, batch):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            try:
+                self.sock.connect(self.path)
+            except OSError:
+                self.close()
+                raise
+        
+        data = ''.join(json.dumps(event) + '\n' for event in batch).encode()
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            # Reconectar en el siguiente lote
+            self.close()
+            raise
+    
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+class JsonlFileSink:
+    """Agregar eventos a un archivo JSONL (para consumir con tail -f)"""
+    def __init__(self, path):
+        self.name = f"jsonl:{path}"
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'a')
+    
+    def send(self, batch):
+        for event in batch:
+            self.file.write(json.dumps(event) + '\n')
+        self.file.flush()
+    
+    def close(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+class EventPublisher:
+    """Publicar eventos de detección en lotes sin bloquear los hilos de cámara"""
+    SINK_TYPES = {'webhook': WebhookSink, 'unix': UnixSocketSink, 'jsonl': JsonlFileSink}
+    
+    def __init__(self, sinks, queue_size=1000, batch_size=50, batch_interval=0.5,
+                 max_backoff=60, error_log_interval=60):
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_backoff = max_backoff
+        self.error_log_interval = error_log_interval
+        self.queues = {sink.name: queue.Queue(maxsize=queue_size) for sink in sinks}
+        self.stats = {sink.name: {'queued': 0, 'sent': 0, 'dropped': 0, 'errors': 0} for sink in sinks}
+        self.stats_lock = threading.Lock()
+        self.running = False
+        self.threads = []
+    
+    @classmethod
+    def from_config(cls, value, queue_size=1000, batch_size=50, batch_interval=0.5):
+        """Crear publicador desde 'tipo:destino,tipo:destino' (webhook, unix, jsonl)"""
+        sinks = []
+        for entry in value.split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            
+            sink_type, _, target = entry.partition(':')
+            sink_class = cls.SINK_TYPES.get(sink_type.strip().lower())
+            if sink_class is None or not target:
+                print(f"Destino de eventos no válido: {entry}")
+                continue
+            
+            try:
+                sinks.append(sink_class(target.strip()))
+            except Exception as e:
+                print(f"Error creando destino de eventos {entry}: {e}")
+        
+        return cls(sinks, queue_size, batch_size, batch_interval)
+    
+    def start(self):
+        self.running = True
+        for sink in self.sinks:
+            thread = threading.Thread(target=self.sink_worker, args=(sink,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+    
+    def publish(self, event_type, camera_index, **data):
+        """Encolar evento en cada destino; si la cola está llena se descarta"""
+        if not self.sinks:
+            return
+        
+        event = {
+            'type': event_type,
+            'camera_index': int(camera_index),
+            'timestamp': datetime.now().isoformat(),
+            **data
+        }
+        for sink in self.sinks:
+            try:
+                self.queues[sink.name].put_nowait(event)
+                counter = 'queued'
+            except queue.Full:
+                counter = 'dropped'
+            with self.stats_lock:
+                self.stats[sink.name][counter] += 1
+    
+    def sink_worker(self, sink):
+        """Agrupar eventos de la cola y enviarlos al destino"""
+        event_queue = self.queues[sink.name]
+        backoff = 0
+        failures = 0
+        last_error_log = 0
+        
+        while self.running or not event_queue.empty():
+            try:
+                batch = [event_queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+            
+            deadline = time.time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(event_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                sink.send(batch)
+                counter = 'sent'
+                if failures:
+                    print(f"Destino de eventos {sink.name} recuperado tras {failures} error(es)")
+                backoff = 0
+                failures = 0
+            except Exception as e:
+                failures += 1
+                # Un destino caído no debe inundar el log: un mensaje por intervalo
+                if time.time() - last_error_log >= self.error_log_interval:
+                    print(f"Error enviando eventos a {sink.name}: {e} ({failures} error(es) seguidos)")
+                    last_error_log = time.time()
+                with self.stats_lock:
+                    self.stats[sink.name]['errors'] += 1
+                counter = 'dropped'
+                backoff = min(self.max_backoff, backoff * 2 if backoff else self.batch_interval)
+            with self.stats_lock:
+                self.stats[sink.name][counter] += len(batch)
+            
+            # Espera exponencial por destino; mientras tanto la cola se llena y descarta con contador
+            backoff_until = time.time() + backoff
+            while self.running and time.time() < backoff_until:
+                time.sleep(min(0.5, backoff_until - time.time()))
+    
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout=2)
+        for sink in self.sinks:
+            sink.close()
+        
+        for name, stats in self.stats.items():
+            print(f"Eventos {name}: enviados {stats['sent']}, descartados {stats['dropped']}, errores {stats['errors']}")
+
+class StreamHub:
+    """Último frame codificado de una vista, compartido por todos sus clientes"""
+    def __init__(self, name):
+        self.name = name
+        self.condition = threading.Condition()
+        self.clients = 0
+        self.raw_frame = None
+        self.raw_detections = []
+        self.raw_sequence = 0
+        self.rendered_sequence = 0
+        self.image = None
+        self.jpeg = None
+        self.sequence = 0
+    
+    def update_raw(self, frame_data, detections):
+        """Guardar el frame crudo más reciente (sin codificar)"""
+        self.raw_frame = frame_data
+        self.raw_detections = detections
+        self.raw_sequence += 1
+    
+    def publish(self, jpeg):
+        with self.condition:
+            self.jpeg = jpeg
+            self.sequence += 1
+            self.condition.notify_all()
+    
+    def wait_frame(self, last_sequence, timeout=5):
+        """Esperar un frame más nuevo que last_sequence. Devuelve (secuencia, jpeg)"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence != last_sequence, timeout=timeout)
+            return self.sequence, self.jpeg
+
+class RestreamHandler(BaseHTTPRequestHandler):
+    """Servir vistas MJPEG anotadas"""
+    BOUNDARY = 'frame'
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_GET(self):
+        restream = self.server.restream
+        path = self.path.split('?')[0]
+        
+        if path == '/':
+            self.send_index(restream)
+            return
+        
+        if path == '/profile':
+            self.send_profile(restream)
+            return
+        
+        if path in ('/mosaic.mjpg', '/mosaic.jpg'):
+            hub = restream.mosaic
+        else:
+            match = re.match(r'^/camera/(\d+)\.(mjpg|jpg)$', path)
+            hub = restream.camera_hubs.get(int(match.group(1))) if match else None
+        
+        if hub is None:
+            self.send_error(404)
+            return
+        
+        if path.endswith('.jpg'):
+            self.send_snapshot(restream, hub)
+        else:
+            self.send_mjpeg(restream, hub)
+    
+    def send_index(self, restream):
+        links = ''.join(f'<li><a href="/camera/{n}.mjpg">Cámara {n}</a></li>' for n in sorted(restream.camera_hubs))
+        body = (f'<html><body><h1>RTSP Viewer</h1><ul>{links}'
+                f'<li><a href="/mosaic.mjpg">Mosaico</a></li></ul></body></html>').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_profile(self, restream):
+        """Iniciar perfilado (sólo desde localhost): /profile?seconds=N"""
+        if restream.profiler is None or self.client_address[0] not in ('127.0.0.1', '::1'):
+            self.send_error(403)
+            return
+        
+        match = re.search(r'seconds=(\d+(?:\.\d+)?)', self.path)
+        seconds = float(match.group(1)) if match else None
+        started = restream.profiler.start(seconds)
+        body = json.dumps({'started': started}).encode()
+        self.send_response(202 if started else 409)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_snapshot(self, restream, hub):
+        if not restream.accept_client():
+            self.send_error(503, 'Demasiados clientes')
+            return
+        
+        try:
+            # Usar el último frame codificado; sólo si no hay ninguno se espera al encoder
+            jpeg = hub.jpeg
+            if jpeg is None:
+                with restream.client(hub):
+                    _, jpeg = hub.wait_frame(0)
+        finally:
+            restream.release_client()
+        
+        if jpeg is None:
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(jpeg)))
+        self.end_headers()
+        self.wfile.write(jpeg)
+    
+    def send_mjpeg(self, restream, hub):
+        if not restream.accept_client():
+            self.send_error(503, 'Demasiados clientes')
+            return
+        
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={self.BOUNDARY}')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            # Un cliente lento no bloquea a los demás: siempre recibe el último frame
+            self.connection.settimeout(restream.client_timeout)
+            
+            with restream.client(hub):
+                last_sequence = hub.sequence
+                first_frame = True
+                while restream.running:
+                    sequence, jpeg = hub.wait_frame(last_sequence)
+                    if sequence == last_sequence or jpeg is None:
+                        continue
+                    if not first_frame and sequence - last_sequence > 1:
+                        restream.count_dropped(sequence - last_sequence - 1)
+                    last_sequence = sequence
+                    first_frame = False
+                    
+                    self.wfile.write(f'--{self.BOUNDARY}\r\n'.encode())
+                    self.wfile.write(b'Content-Type: image/jpeg\r\n')
+                    self.wfile.write(f'Content-Length: {len(jpeg)}\r\n\r\n'.encode())
+                    self.wfile.write(jpeg)
+                    self.wfile.write(b'\r\n')
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            restream.release_client()
+
+class RestreamServer:
+    """Servidor HTTP embebido con vistas anotadas (codificadas una vez por vista)"""
+    def __init__(self, render, host='127.0.0.1', port=8080, fps=10, quality=75,
+                 max_clients=20, tile_width=320, tile_height=240, client_timeout=10, profiler=None):
+        self.render = render
+        self.profiler = profiler
+        self.host = host
+        self.port = port
+        self.fps = fps
+        self.quality = quality
+        self.max_clients = max_clients
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.client_timeout = client_timeout
+        
+        self.camera_hubs = {}
+        self.mosaic = StreamHub('mosaic')
+        self.running = False
+        self.active_clients = 0
+        self.dropped_frames = 0
+        self.clients_lock = threading.Lock()
+        self.httpd = None
+        self.threads = []
+    
+    def add_camera(self, camera_number):
+        self.camera_hubs[camera_number] = StreamHub(f'camera_{camera_number}')
+    
+    def update(self, camera_number, frame_data, detections):
+        """Llamado desde camera_thread: sólo guarda referencias, no codifica"""
+        hub = self.camera_hubs.get(camera_number)
+        if hub:
+            hub.update_raw(frame_data, detections)
+    
+    def accept_client(self):
+        with self.clients_lock:
+            if self.active_clients >= self.max_clients:
+                return False
+            self.active_clients += 1
+            return True
+    
+    def release_client(self):
+        with self.clients_lock:
+            self.active_clients -= 1
+    
+    def count_dropped(self, frames):
+        with self.clients_lock:
+            self.dropped_frames += frames
+    
+    def client(self, hub):
+        """Context manager que registra un espectador en la vista"""
+        server = self
+        
+        class _Client:
+            def __enter__(self):
+                with server.clients_lock:
+                    hub.clients += 1
+            
+            def __exit__(self, *exc):
+                with server.clients_lock:
+                    hub.clients -= 1
+        
+        return _Client()
+    
+    def encode(self, image):
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=self.quality)
+        return buffer.getvalue()
+    
+    def encoder_loop(self):
+        """Renderizar y codificar cada vista una sola vez por tick, sólo si tiene espectadores"""
+        interval = 1.0 / self.fps
+        
+        while self.running:
+            tick_start = time.time()
+            mosaic_active = self.mosaic.clients > 0
+            mosaic_changed = False
+            
+            for hub in self.camera_hubs.values():
+                if not (hub.clients or mosaic_active):
+                    continue
+                if hub.raw_frame is None or hub.raw_sequence == hub.rendered_sequence:
+                    continue
+                
+                try:
+                    hub.rendered_sequence = hub.raw_sequence
+                    hub.image = self.render(hub.raw_frame, hub.raw_detections)
+                    mosaic_changed = True
+                    if hub.clients:
+                        hub.publish(self.encode(hub.image))
+                except Exception as e:
+                    print(f"Error codificando vista {hub.name}: {e}")
+            
+            if mosaic_active and mosaic_changed:
+                try:
+                    self.mosaic.publish(self.encode(self.compose_mosaic()))
+                except Exception as e:
+                    print(f"Error codificando mosaico: {e}")
+            
+            elapsed = time.time() - tick_start
+            if elapsed < interval:
+                time.sleep(interval - elapsed)
+    
+    def compose_mosaic(self):
+        """Componer una cuadrícula con la última imagen de cada cámara"""
+        numbers = sorted(self.camera_hubs)
+        columns = max(1, int(np.ceil(np.sqrt(len(numbers)))))
+        rows = max(1, int(np.ceil(len(numbers) / columns)))
+        mosaic = Image.new('RGB', (columns * self.tile_width, rows * self.tile_height))
+        
+        for position, number in enumerate(numbers):
+            image = self.camera_hubs[number].image
+            if image is None:
+                continue
+            tile = image.resize((self.tile_width, self.tile_height), Image.Resampling.BILINEAR)
+            x = (position % columns) * self.tile_width
+            y = (position // columns) * self.tile_height
+            mosaic.paste(tile, (x, y))
+        
+        return mosaic
+    
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), RestreamHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.restream = self
+        self.running = True
+        
+        for target in (self.httpd.serve_forever, self.encoder_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        
+        print(f"✓ Restream activo en http://{self.host}:{self.port}/")
+    
+    def stop(self):
+        self.running = False
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        for thread in self.threads:
+            thread.join(timeout=2)
+        print(f"Restream detenido. Frames descartados a clientes lentos: {self.dropped_frames}")
+
+class RecordingStore:
+    """Almacenamiento de grabaciones con presupuesto de disco y borrado de clips antiguos"""
+    def __init__(self, root='recordings', spool_dir=None, budget_bytes=0, camera_quota_bytes=0,
+                 camera_quotas=None, min_free_bytes=0, priority_classes=(), priority_retention=0,
+                 evict_interval=60, free_space_ttl=10):
+        self.root = root
+        self.spool_dir = spool_dir or tempfile.gettempdir()
+        self.budget_bytes = budget_bytes
+        self.camera_quota_bytes = camera_quota_bytes
+        self.camera_quotas = camera_quotas or {}
+        self.min_free_bytes = min_free_bytes
+        self.priority_classes = set(priority_classes)
+        self.priority_retention = priority_retention
+        self.evict_interval = evict_interval
+        self.free_space_ttl = free_space_ttl
+        
+        self.clips = {}  # stem -> {'port', 'size', 'mtime', 'classes'}
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        self.dirs_lock = threading.Lock()
+        self.free_space_cache = (0, None)  # (timestamp, bytes libres)
+        self.wake_event = threading.Event()
+        self.scanned = threading.Event()
+        self.running = False
+        self.thread = None
+        
+        os.makedirs(self.root, exist_ok=True)
+        os.makedirs(self.spool_dir, exist_ok=True)
+    
+    def clip_files(self, stem):
+        """Archivos que pertenecen a un clip (video, metadatos y derivados)"""
+        return glob.glob(glob.escape(stem) + '.*') + glob.glob(glob.escape(stem) + '_*')
+    
+    def scan(self):
+        """Indexar una sola vez las grabaciones existentes"""
+        scan_start = time.time()
+        clips = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith('.mp4'):
+                    continue
+                stem = os.path.join(dirpath, filename[:-4])
+                clips[stem] = self.read_clip(stem)
+        
+        # Conservar los clips registrados con add_clip mientras se recorría el árbol
+        with self.lock:
+            for stem, clip in clips.items():
+                self.clips.setdefault(stem, clip)
+            total = sum(clip['size'] for clip in self.clips.values())
+            count = len(self.clips)
+        self.scanned.set()
+        
+        print(f"Grabaciones indexadas: {count} clips, {total / 1024**3:.2f} GB "
+              f"({time.time() - scan_start:.2f}s)")
+    
+    def read_clip(self, stem, metadata=None):
+        """Tamaño, fecha, cámara y clases de un clip"""
+        size = 0
+        mtime = 0
+        for path in self.clip_files(stem):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+        
+        if metadata is None:
+            try:
+                with open(f"{stem}.json") as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                metadata = {}
+        
+        return {
+            'port': metadata.get('port'),
+            'size': size,
+            'mtime': mtime,
+            'classes': {det.get('class') for det in metadata.get('detections', [])}
+        }
+    
+    def add_clip(self, stem, metadata):
+        """Registrar un clip recién guardado"""
+        clip = self.read_clip(stem, metadata)
+        with self.lock:
+            self.clips[stem] = clip
+        self.wake_event.set()
+    
+    def free_bytes(self):
+        """Espacio libre en disco, cacheado free_space_ttl segundos"""
+        timestamp, free = self.free_space_cache
+        if free is None or time.time() - timestamp > self.free_space_ttl:
+            free = shutil.disk_usage(self.root).free
+            self.free_space_cache = (time.time(), free)
+        return free
+    
+    def ensure_space(self):
+        """Liberar espacio antes de guardar si el disco está por debajo del mínimo"""
+        if not self.min_free_bytes or self.free_bytes() >= self.min_free_bytes:
+            return True
+        self.evict()
+        return self.free_bytes() >= self.min_free_bytes
+    
+    def is_protected(self, clip, now):
+        """Clips con clases prioritarias se conservan durante priority_retention segundos"""
+        return bool(clip['classes'] & self.priority_classes) and now - clip['mtime'] < self.priority_retention
+    
+    def eviction_order(self, clips):
+        """Más antiguos primero; los protegidos sólo cuando no quedan otros"""
+        now = time.time()
+        return sorted(clips, key=lambda item: (self.is_protected(item[1], now), item[1]['mtime']))
+    
+    def delete_clip(self, stem):
+        for path in self.clip_files(stem):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Error borrando {path}: {e}")
+        
+        with self.lock:
+            clip = self.clips.pop(stem, None)
+        
+        self.prune_dirs(os.path.dirname(stem))
+        return clip
+    
+    def make_clip_dir(self, now):
+        """Crear el directorio YYYY/MM/DD de una grabación"""
+        full_path = f"{self.root}/{now.strftime('%Y/%m/%d')}"
+        with self.dirs_lock:
+            os.makedirs(full_path, exist_ok=True)
+        return full_path
+    
+    def prune_dirs(self, directory):
+        """Borrar directorios de fecha vacíos, sin llegar nunca a root ni tocar el del día actual"""
+        root = os.path.abspath(self.root)
+        today = os.path.abspath(os.path.join(self.root, datetime.now().strftime('%Y/%m/%d')))
+        directory = os.path.abspath(directory)
+        
+        with self.dirs_lock:
+            while directory.startswith(root + os.sep) and directory != today:
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+    
+    def evict(self):
+        """Borrar clips hasta cumplir presupuesto global, cuotas por cámara y espacio mínimo"""
+        # Con el índice incompleto se borrarían clips en mal orden
+        if not self.scanned.is_set():
+            return
+        with self.evict_lock:
+            self.evict_locked()
+    
+    def evict_locked(self):
+        with self.lock:
+            clips = list(self.clips.items())
+        
+        deleted = 0
+        freed = 0
+        
+        # Cuotas por cámara (clave: puerto, igual que las zonas)
+        by_port = {}
+        for stem, clip in clips:
+            by_port.setdefault(clip['port'], []).append((stem, clip))
+        for port, camera_clips in by_port.items():
+            # Clips anteriores sin puerto en su JSON: sólo presupuesto global y espacio mínimo
+            if port is None:
+                continue
+            quota = self.camera_quotas.get(port, self.camera_quota_bytes)
+            if not quota:
+                continue
+            used = sum(clip['size'] for _, clip in camera_clips)
+            for stem, clip in self.eviction_order(camera_clips):
+                if used <= quota:
+                    break
+                self.delete_clip(stem)
+                used -= clip['size']
+                freed += clip['size']
+                deleted += 1
+        
+        # Presupuesto global y espacio libre mínimo
+        with self.lock:
+            clips = list(self.clips.items())
+        used = sum(clip['size'] for _, clip in clips)
+        free = None
+        if self.min_free_bytes:
+            self.free_space_cache = (0, None)
+            free = self.free_bytes()
+        for stem, clip in self.eviction_order(clips):
+            over_budget = self.budget_bytes and used > self.budget_bytes
+            low_space = self.min_free_bytes and free < self.min_free_bytes
+            if not (over_budget or low_space):
+                break
+            self.delete_clip(stem)
+            used -= clip['size']
+            freed += clip['size']
+            if self.min_free_bytes:
+                free += clip['size']
+            deleted += 1
+        
+        if deleted:
+            self.free_space_cache = (0, None)
+            print(f"Retención: {deleted} clip(s) borrados, {freed / 1024**2:.1f} MB liberados")
+    
+    def evictor_loop(self):
+        # El recorrido inicial se hace aquí para no retrasar el arranque de las cámaras
+        try:
+            self.scan()
+        except Exception as e:
+            # Sin índice completo no se borra nada
+            print(f"Error indexando grabaciones, retención desactivada: {e}")
+        
+        while self.running:
+            try:
+                self.evict()
+            except Exception as e:
+                print(f"Error en retención de grabaciones: {e}")
+            self.wake_event.wait(self.evict_interval)
+            self.wake_event.clear()
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.evictor_loop, name='retencion', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.wake_event.set()
+        if self.thread:
+            self.thread.join(timeout=2)
+
+class ClipFrames:
+    """Frames ya decodificados de un clip para generar miniaturas al guardarlo"""
+    def __init__(self, max_keyframes=8, stride=30):
+        self.max_keyframes = max_keyframes
+        self.stride = stride
+        self.frame_count = 0
+        self.keyframes = []
+        self.best_frame = None
+        self.best_detections = []
+        self.best_confidence = 0.0
+    
+    def add_frame(self, frame_data):
+        """Guardar una referencia cada `stride` frames; al llenarse se diezma a la mitad"""
+        if self.frame_count % self.stride == 0:
+            self.keyframes.append(frame_data)
+            if len(self.keyframes) >= self.max_keyframes * 2:
+                self.keyframes = self.keyframes[::2]
+                self.stride *= 2
+        self.frame_count += 1
+    
+    def add_detection(self, frame_array, detections):
+        """Conservar el frame con la detección de mayor confianza"""
+        confidence = max(det['confidence'] for det in detections)
+        if frame_array is not None and confidence > self.best_confidence:
+            self.best_frame = frame_array
+            self.best_detections = detections
+            self.best_confidence = confidence
+    
+    def sprite_frames(self):
+        """Hasta max_keyframes frames repartidos uniformemente en el clip"""
+        if len(self.keyframes) <= self.max_keyframes:
+            return list(self.keyframes)
+        step = len(self.keyframes) / self.max_keyframes
+        return [self.keyframes[int(i * step)] for i in range(self.max_keyframes)]
+
+class _NullStage:
+    """Etapa sin perfilado activo: no hace nada"""
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+
+class _ProfiledStage:
+    """Etapa perfilada: marca la etapa actual del hilo y, si se usa cProfile, un perfil por etapa e hilo"""
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.profile = None
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        ident = threading.get_ident()
+        self.previous_stage = self.profiler.current_stages.get(ident)
+        self.profiler.current_stages[ident] = self.name
+        
+        if self.profiler.use_cprofile:
+            self.profile = self.profiler.stage_profile(self.name)
+        if self.profile is not None:
+            try:
+                self.profile.enable()
+            except ValueError:
+                # Otro perfilador ya activo: la etapa se resume con las muestras
+                self.profile = None
+        return self
+    
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+        ident = threading.get_ident()
+        if self.previous_stage is None:
+            self.profiler.current_stages.pop(ident, None)
+        else:
+            self.profiler.current_stages[ident] = self.previous_stage
+        self.profiler.add_stage_time(self.name, time.perf_counter() - self.start)
+        return False
+
+class SamplingProfiler:
+    """Perfilador bajo demanda: muestrea todos los hilos y perfila las etapas del pipeline
+
+    En Python 3.12+ cProfile usa sys.monitoring: un único perfilador por proceso que registra
+    todos los hilos. Ahí el desglose por etapa se construye con las muestras de cada hilo
+    según la etapa en la que estaba.
+    """
+    def __init__(self, output_dir='profiles', interval=0.01, default_seconds=10, use_cprofile=None):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.default_seconds = default_seconds
+        self.use_cprofile = sys.version_info < (3, 12) if use_cprofile is None else use_cprofile
+        self.active = False
+        self.lock = threading.Lock()
+        self.null_stage = _NullStage()
+        self.stacks = {}
+        self.stage_stacks = {}
+        self.current_stages = {}  # ident del hilo -> etapa en curso
+        self.stage_profiles = {}
+        self.stage_times = {}
+        self.sample_thread = None
+        self.trigger_event = threading.Event()
+        self.trigger_thread = None
+    
+    def trigger(self):
+        """Pedir una captura desde un manejador de señal: sólo marca el evento"""
+        self.trigger_event.set()
+    
+    def start_trigger_listener(self):
+        """Hilo que inicia la captura cuando se llama a trigger()"""
+        if self.trigger_thread is None:
+            self.trigger_thread = threading.Thread(target=self.trigger_loop, name='profiler_trigger', daemon=True)
+            self.trigger_thread.start()
+    
+    def trigger_loop(self):
+        while True:
+            self.trigger_event.wait()
+            self.trigger_event.clear()
+            self.start()
+    
+    def stage(self, name):
+        """Context manager para una etapa; sin coste apreciable si no hay perfilado activo"""
+        if not self.active:
+            return self.null_stage
+        return _ProfiledStage(self, name)
+    
+    def stage_profile(self, name):
+        key = (name, threading.get_ident())
+        with self.lock:
+            if not self.active:
+                return None
+            if key not in self.stage_profiles:
+                self.stage_profiles[key] = cProfile.Profile()
+            return self.stage_profiles[key]
+    
+    def add_stage_time(self, name, duration):
+        with self.lock:
+            calls, total = self.stage_times.get(name, (0, 0.0))
+            self.stage_times[name] = (calls + 1, total + duration)
+    
+    def start(self, seconds=None):
+        """Iniciar una captura de `seconds` segundos. False si ya hay una en curso"""
+        with self.lock:
+            if self.active:
+                return False
+            self.active = True
+            self.stacks = {}
+            self.stage_stacks = {}
+            self.stage_profiles = {}
+            self.stage_times = {}
+        
+        seconds = seconds or self.default_seconds
+        self.sample_thread = threading.Thread(target=self.sample_loop, args=(seconds,), name='profiler', daemon=True)
+        self.sample_thread.start()
+        print(f"Perfilado iniciado durante {seconds}s")
+        return True
+    
+    def sample_loop(self, seconds):
+        own_ident = threading.get_ident()
+        deadline = time.time() + seconds
+        samples = 0
+        
+        while time.time() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                
+                stage = self.current_stages.get(ident)
+                if stage:
+                    stage_stacks = self.stage_stacks.setdefault(stage, {})
+                    stage_stacks[key] = stage_stacks.get(key, 0) + 1
+            samples += 1
+            time.sleep(self.interval)
+        
+        with self.lock:
+            self.active = False
+        
+        try:
+            self.write_results(samples)
+        except Exception as e:
+            print(f"Error guardando perfil: {e}")
+    
+    def write_cprofile_summary(self, f, profiles):
+        """Resumen pstats de los perfiles con datos. False si ninguno tiene datos"""
+        profiles = [profile for profile in profiles if profile.getstats()]
+        if not profiles:
+            return False
+        try:
+            stats = pstats.Stats(profiles[0], stream=f)
+            for profile in profiles[1:]:
+                stats.add(profile)
+        except (TypeError, ValueError):
+            return False
+        stats.sort_stats('cumulative').print_stats(30)
+        return True
+    
+    def write_sample_summary(self, f, name):
+        """Resumen por función a partir de las muestras tomadas dentro de la etapa"""
+        stage_stacks = self.stage_stacks.get(name, {})
+        total = sum(stage_stacks.values())
+        f.write(f"Etapa {name}: {total} muestras cada {self.interval * 1000:.0f} ms\n\n")
+        if not total:
+            return
+        
+        own = {}
+        inclusive = {}
+        for key, count in stage_stacks.items():
+            functions = key.split(';')[1:]
+            if functions:
+                own[functions[-1]] = own.get(functions[-1], 0) + count
+            for function in set(functions):
+                inclusive[function] = inclusive.get(function, 0) + count
+        
+        f.write(f"{'inclusivo':>10} {'propio':>10}  función\n")
+        for function, count in sorted(inclusive.items(), key=lambda item: -item[1])[:30]:
+            f.write(f"{count / total:>10.1%} {own.get(function, 0) / total:>10.1%}  {function}\n")
+    
+    def write_results(self, samples):
+        """Escribir pilas colapsadas (flamegraph), tiempos por etapa y un resumen por etapa"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"profile_{datetime.now().strftime('%Y%m%d%H%M%S')}")
+        
+        with open(f"{prefix}.collapsed", 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        
+        # Alguna etapa puede terminar después de cerrar la captura
+        with self.lock:
+            stage_times = dict(self.stage_times)
+        
+        with open(f"{prefix}_etapas.txt", 'w') as f:
+            f.write(f"{'etapa':<20} {'llamadas':>10} {'total_s':>10} {'media_ms':>10}\n")
+            for name, (calls, total) in sorted(stage_times.items(), key=lambda item: -item[1][1]):
+                f.write(f"{name:<20} {calls:>10} {total:>10.3f} {total / calls * 1000:>10.2f}\n")
+        
+        profiles_by_stage = {}
+        for (name, _), profile in self.stage_profiles.items():
+            profiles_by_stage.setdefault(name, []).append(profile)
+        
+        stages = set(stage_times) | set(self.stage_stacks)
+        for name in stages:
+            with open(f"{prefix}_{name}.txt", 'w') as f:
+                # cProfile si hay datos; si no (3.12+ o perfil vacío), resumen por muestras
+                if not self.write_cprofile_summary(f, profiles_by_stage.get(name, [])):
+                    self.write_sample_summary(f, name)
+        
+        print(f"Perfil guardado: {prefix}.collapsed ({samples} muestras) y {len(stages)} resumen(es) por etapa")
+
+class RTSPUpstream:
+    """Sesión RTSP única contra la cámara (RTP intercalado sobre TCP)"""
+    def __init__(self, url, username=None, password=None, timeout=10):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        match = re.match(r'^rtsp://([^/:]+)(?::(\d+))?', url)
+        self.host = match.group(1)
+        self.port = int(match.group(2) or 554)
+        
+        self.sock = None
+        self.reader = None
+        self.write_lock = threading.Lock()
+        self.cseq = 0
+        self.auth = None  # (esquema, parámetros) del último 401
+        self.session_id = None
+        self.session_timeout = 60
+        self.sdp = None
+        self.track_count = 0
+        self.play_url = url
+    
+    def authorization(self, method, uri):
+        if not self.auth or not self.username:
+            return None
+        scheme, params = self.auth
+        if scheme == 'basic':
+            token = base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
+            return f"Basic {token}"
+        
+        realm = params.get('realm', '')
+        nonce = params.get('nonce', '')
+        ha1 = hashlib.md5(f"{self.username}:{realm}:{self.password}".encode()).hexdigest()
+        ha2 = hashlib.md5(f"{method}:{uri}".encode()).hexdigest()
+        header = f'Digest username="{self.username}", realm="{realm}", nonce="{nonce}", uri="{uri}"'
+        if 'auth' in params.get('qop', '').split(','):
+            cnonce = uuid.uuid4().hex[:16]
+            nc = f"{self.cseq:08x}"
+            response = hashlib.md5(f"{ha1}:{nonce}:{nc}:{cnonce}:auth:{ha2}".encode()).hexdigest()
+            header += f', qop=auth, nc={nc}, cnonce="{cnonce}"'
+        else:
+            response = hashlib.md5(f"{ha1}:{nonce}:{ha2}".encode()).hexdigest()
+        header += f', response="{response}"'
+        if 'opaque' in params:
+            header += f', opaque="{params["opaque"]}"'
+        return header
+    
+    @staticmethod
+    def parse_authenticate(value):
+        scheme, _, rest = value.partition(' ')
+        params = dict(re.findall(r'(\w+)="?([^",]*)"?', rest))
+        return scheme.lower(), params
+    
+    def send_request(self, method, uri, headers=None):
+        self.cseq += 1
+        lines = [f"{method} {uri} RTSP/1.0", f"CSeq: {self.cseq}", "User-Agent: camaras-relay"]
+        authorization = self.authorization(method, uri)
+        if authorization:
+            lines.append(f"Authorization: {authorization}")
+        if self.session_id:
+            lines.append(f"Session: {self.session_id}")
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        with self.write_lock:
+            self.sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    
+    def read_message(self):
+        """Leer un paquete intercalado ('$', canal, datos) o una respuesta RTSP"""
+        first = self.reader.read(1)
+        if not first:
+            raise ConnectionError("Conexión cerrada por la cámara")
+        if first == b'$':
+            header = self.reader.read(3)
+            channel, length = header[0], struct.unpack('>H', header[1:3])[0]
+            payload = self.reader.read(length)
+            if len(payload) != length:
+                raise ConnectionError("Paquete RTP incompleto")
+            return 'data', channel, first + header + payload
+        
+        status_line = (first + self.reader.readline()).decode(errors='replace').strip()
+        headers = {}
+        while True:
+            line = self.reader.readline().decode(errors='replace').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = b''
+        if 'content-length' in headers:
+            body = self.reader.read(int(headers['content-length']))
+        parts = status_line.split(' ', 2)
+        status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        return 'response', status, (headers, body)
+    
+    def request(self, method, uri, headers=None):
+        """Enviar petición y esperar su respuesta (reintenta una vez con autenticación)"""
+        for _ in range(2):
+            self.send_request(method, uri, headers)
+            while True:
+                kind, status, data = self.read_message()
+                if kind == 'response':
+                    break
+            response_headers, body = data
+            if status == 401 and 'www-authenticate' in response_headers and self.username:
+                self.auth = self.parse_authenticate(response_headers['www-authenticate'])
+                continue
+            if status != 200:
+                raise ConnectionError(f"{method} respondió {status}")
+            return response_headers, body
+        raise ConnectionError(f"{method} no autorizado")
+    
+    def resolve_control(self, base, control):
+        if control.startswith('rtsp://'):
+            return control
+        if not control or control == '*':
+            return base
+        return base + control if base.endswith('/') else f"{base}/{control}"
+    
+    def open(self):
+        """DESCRIBE, SETUP de cada pista intercalada y PLAY"""
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.reader = self.sock.makefile('rb')
+        
+        headers, body = self.request('DESCRIBE', self.url, {'Accept': 'application/sdp'})
+        self.sdp = body.decode(errors='replace')
+        base = headers.get('content-base') or headers.get('content-location') or self.url
+        
+        session_control = None
+        track_controls = []
+        for line in self.sdp.splitlines():
+            if line.startswith('m='):
+                track_controls.append(None)
+            elif line.startswith('a=control:'):
+                if track_controls:
+                    track_controls[-1] = line[len('a=control:'):].strip()
+                else:
+                    session_control = line[len('a=control:'):].strip()
+        
+        if session_control and session_control != '*':
+            base = self.resolve_control(base, session_control)
+        
+        for index, control in enumerate(track_controls):
+            transport = f"RTP/AVP/TCP;unicast;interleaved={index * 2}-{index * 2 + 1}"
+            response_headers, _ = self.request('SETUP', self.resolve_control(base, control or ''),
+                                               {'Transport': transport})
+            if 'session' in response_headers and not self.session_id:
+                session_parts = response_headers['session'].split(';')
+                self.session_id = session_parts[0].strip()
+                for part in session_parts[1:]:
+                    if part.strip().startswith('timeout='):
+                        self.session_timeout = int(part.strip()[len('timeout='):])
+        self.track_count = len(track_controls)
+        
+        self.request('PLAY', base, {'Range': 'npt=0.000-'})
+        self.play_url = base
+        # El bucle de lectura bloquea sin límite; la cámara envía datos continuamente
+        self.sock.settimeout(self.session_timeout * 2)
+    
+    def keepalive(self):
+        self.send_request('GET_PARAMETER', self.play_url)
+    
+    def close(self):
+        if self.sock:
+            try:
+                self.send_request('TEARDOWN', self.play_url)
+            except Exception:
+                pass
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+class RelayClient:
+    """Cliente local del relay con cola acotada (descarta paquetes si es lento)"""
+    def __init__(self, sock, queue_size):
+        self.sock = sock
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.channel_map = {}  # canal de la cámara -> canal del cliente
+        self.playing = False
+        self.dropped = 0
+        self.closed = False
+    
+    def enqueue(self, channel, packet):
+        mapped = self.channel_map.get(channel)
+        if mapped is None:
+            return
+        if mapped != channel:
+            packet = packet[:1] + bytes([mapped]) + packet[2:]
+        try:
+            self.queue.put_nowait(packet)
+        except queue.Full:
+            self.dropped += 1
+    
+    def writer_loop(self):
+        while not self.closed:
+            try:
+                packet = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if packet is None:
+                break
+            try:
+                self.sock.sendall(packet)
+            except OSError:
+                break
+        self.close()
+    
+    def close(self):
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class RTSPRelay:
+    """Relay RTSP local: una sola sesión con la cámara repartida a todos los clientes locales"""
+    def __init__(self, upstream_url, username, password, listen_port, listen_host='127.0.0.1',
+                 idle_timeout=30, client_queue=2000):
+        self.upstream_url = upstream_url
+        self.username = username
+        self.password = password
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.idle_timeout = idle_timeout
+        self.client_queue = client_queue
+        
+        self.upstream = None
+        self.upstream_lock = threading.Lock()
+        self.clients = []
+        self.clients_lock = threading.Lock()
+        self.last_client_time = time.time()
+        self.running = False
+        self.server_sock = None
+        self.sessions_opened = 0
+        self.dropped_packets = 0
+    
+    def local_url(self, path):
+        return f"rtsp://{self.listen_host}:{self.listen_port}{path}"
+    
+    def start(self):
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_sock.bind((self.listen_host, self.listen_port))
+        self.listen_port = self.server_sock.getsockname()[1]  # puerto real si se pidió 0
+        self.server_sock.listen(16)
+        self.server_sock.settimeout(1)
+        self.running = True
+        
+        for target in (self.accept_loop, self.idle_loop):
+            threading.Thread(target=target, name=f'relay_{self.listen_port}', daemon=True).start()
+    
+    def accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.server_sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            conn.settimeout(None)
+            threading.Thread(target=self.handle_client, args=(conn,), daemon=True).start()
+    
+    def idle_loop(self):
+        """Cerrar la sesión con la cámara si no hay clientes durante idle_timeout"""
+        next_keepalive = 0
+        while self.running:
+            time.sleep(1)
+            with self.clients_lock:
+                has_clients = bool(self.clients)
+                if has_clients:
+                    self.last_client_time = time.time()
+            
+            with self.upstream_lock:
+                upstream = self.upstream
+                if upstream and not has_clients and time.time() - self.last_client_time > self.idle_timeout:
+                    upstream.close()
+                    self.upstream = None
+                    continue
+            
+            if upstream and time.time() >= next_keepalive:
+                try:
+                    upstream.keepalive()
+                except Exception:
+                    pass
+                next_keepalive = time.time() + max(5, upstream.session_timeout / 2)
+    
+    def ensure_upstream(self):
+        """Abrir la sesión con la cámara si no existe. Devuelve el upstream activo"""
+        with self.upstream_lock:
+            if self.upstream is None:
+                upstream = RTSPUpstream(self.upstream_url, self.username, self.password)
+                try:
+                    upstream.open()
+                except Exception:
+                    upstream.close()
+                    raise
+                self.upstream = upstream
+                self.sessions_opened += 1
+                threading.Thread(target=self.upstream_loop, args=(upstream,), daemon=True).start()
+            return self.upstream
+    
+    def upstream_loop(self, upstream):
+        """Leer paquetes de la cámara y repartirlos a los clientes en reproducción"""
+        try:
+            while self.running and self.upstream is upstream:
+                kind, channel, packet = upstream.read_message()
+                if kind != 'data':
+                    continue
+                with self.clients_lock:
+                    clients = [client for client in self.clients if client.playing]
+                for client in clients:
+                    client.enqueue(channel, packet)
+        except Exception as e:
+            if self.running and self.upstream is upstream:
+                print(f"Relay {self.listen_port}: sesión con la cámara perdida: {e}")
+        finally:
+            with self.upstream_lock:
+                if self.upstream is upstream:
+                    self.upstream = None
+                    upstream.close()
+                    # Los clientes se desconectan para que vuelvan a conectar
+                    with self.clients_lock:
+                        clients = list(self.clients)
+                    for client in clients:
+                        client.close()
+    
+    def rewrite_sdp(self, sdp):
+        """Reemplazar los controles de la cámara por track<n> locales"""
+        lines = []
+        track = -1
+        for line in sdp.splitlines():
+            if line.startswith('a=control:'):
+                continue
+            if line.startswith('m='):
+                if track == -1:
+                    lines.append('a=control:*')
+                track += 1
+                lines.append(line)
+                lines.append(f'a=control:track{track}')
+                continue
+            lines.append(line)
+        return '\r\n'.join(lines) + '\r\n'
+    
+    def handle_client(self, conn):
+        client = RelayClient(conn, self.client_queue)
+        reader = conn.makefile('rb')
+        session_id = uuid.uuid4().hex[:16]
+        writer_started = False
+        
+        with self.clients_lock:
+            self.clients.append(client)
+        try:
+            while self.running and not client.closed:
+                first = reader.read(1)
+                if not first:
+                    break
+                if first == b'$':
+                    # RTCP del cliente: se descarta
+                    header = reader.read(3)
+                    reader.read(struct.unpack('>H', header[1:3])[0])
+                    continue
+                
+                request_line = (first + reader.readline()).decode(errors='replace').strip()
+                headers = {}
+                while True:
+                    line = reader.readline().decode(errors='replace').strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if 'content-length' in headers:
+                    reader.read(int(headers['content-length']))
+                
+                method, uri = (request_line.split(' ') + ['', ''])[:2]
+                response_headers = {'CSeq': headers.get('cseq', '0')}
+                status = '200 OK'
+                body = b''
+                
+                if method == 'OPTIONS':
+                    response_headers['Public'] = 'OPTIONS, DESCRIBE, SETUP, PLAY, TEARDOWN, GET_PARAMETER'
+                elif method == 'DESCRIBE':
+                    try:
+                        upstream = self.ensure_upstream()
+                        body = self.rewrite_sdp(upstream.sdp).encode()
+                        response_headers['Content-Type'] = 'application/sdp'
+                        response_headers['Content-Base'] = uri.rstrip('/') + '/'
+                    except Exception as e:
+                        print(f"Relay {self.listen_port}: error conectando a la cámara: {e}")
+                        status = '503 Service Unavailable'
+                elif method == 'SETUP':
+                    match = re.search(r'track(\d+)$', uri)
+                    interleaved = re.search(r'interleaved=(\d+)(?:-(\d+))?', headers.get('transport', ''))
+                    if not match or not interleaved or 'TCP' not in headers.get('transport', ''):
+                        status = '461 Unsupported Transport'
+                    else:
+                        track = int(match.group(1))
+                        rtp = int(interleaved.group(1))
+                        rtcp = int(interleaved.group(2) or rtp + 1)
+                        client.channel_map[track * 2] = rtp
+                        client.channel_map[track * 2 + 1] = rtcp
+                        response_headers['Transport'] = f"RTP/AVP/TCP;unicast;interleaved={rtp}-{rtcp}"
+                        response_headers['Session'] = f"{session_id};timeout=60"
+                elif method == 'PLAY':
+                    response_headers['Session'] = session_id
+                    response_headers['Range'] = 'npt=0.000-'
+                elif method in ('GET_PARAMETER', 'SET_PARAMETER'):
+                    response_headers['Session'] = session_id
+                elif method == 'TEARDOWN':
+                    response_headers['Session'] = session_id
+                else:
+                    status = '405 Method Not Allowed'
+                
+                response = f"RTSP/1.0 {status}\r\n"
+                response += ''.join(f"{name}: {value}\r\n" for name, value in response_headers.items())
+                response += f"Content-Length: {len(body)}\r\n\r\n"
+                data = response.encode() + body
+                
+                # Las respuestas pasan por la cola del cliente para no mezclarse con paquetes RTP
+                if writer_started:
+                    client.queue.put(data, timeout=5)
+                else:
+                    conn.sendall(data)
+                
+                if method == 'PLAY' and status.startswith('200') and not writer_started:
+                    writer_started = True
+                    threading.Thread(target=client.writer_loop, daemon=True).start()
+                    client.playing = True
+                elif method == 'TEARDOWN':
+                    break
+        except (OSError, ConnectionError, ValueError, queue.Full):
+            pass
+        finally:
+            with self.clients_lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+                self.dropped_packets += client.dropped
+                self.last_client_time = time.time()
+            client.close()
+    
+    def stop(self):
+        self.running = False
+        if self.server_sock:
+            try:
+                self.server_sock.close()
+            except OSError:
+                pass
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+        with self.upstream_lock:
+            if self.upstream:
+                self.upstream.close()
+                self.upstream = None
+        print(f"Relay {self.listen_port}: {self.sessions_opened} sesión(es) con la cámara, "
+              f"{self.dropped_packets} paquetes descartados a clientes lentos")
+
+class DetectionVerifier:
+    """Segunda etapa: confirmar detecciones con un modelo más pesado, en lotes y con límite de tasa"""
+    def __init__(self, model, class_names, conf=0.5, imgsz=320, batch_size=8, batch_wait=0.05,
+                 max_per_second=4, crop_padding=0.2, queue_size=32):
+        self.model = model
+        self.class_names = class_names
+        self.class_ids = {name: cls for cls, name in class_names.items()}
+        self.conf = conf
+        self.imgsz = imgsz
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_per_second = max_per_second
+        self.crop_padding = crop_padding
+        self.queue = queue.Queue(maxsize=queue_size)
+        
+        # Token bucket: recortes verificables por segundo (capacidad mínima de un recorte)
+        self.bucket_capacity = max(float(max_per_second), 1.0)
+        self.tokens = self.bucket_capacity
+        self.last_refill = time.time()
+        self.tokens_lock = threading.Lock()
+        
+        self.stats = {'submitted': 0, 'confirmed': 0, 'rejected': 0, 'rate_limited': 0}
+        self.stats_lock = threading.Lock()
+        self.running = False
+        self.thread = None
+    
+    def take_tokens(self, count):
+        """Tomar hasta `count` tokens. Devuelve cuántos recortes se pueden verificar (0 = limitado)"""
+        with self.tokens_lock:
+            now = time.time()
+            self.tokens = min(self.bucket_capacity, self.tokens + (now - self.last_refill) * self.max_per_second)
+            self.last_refill = now
+            granted = min(count, int(self.tokens))
+            self.tokens -= granted
+            return granted
+    
+    def count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats[name] += amount
+    
+    def crop(self, frame_array, detection):
+        """Recorte de la detección con margen alrededor"""
+        height, width = frame_array.shape[:2]
+        x1, y1, x2, y2 = detection['bbox']
+        pad_x = int((x2 - x1) * self.crop_padding)
+        pad_y = int((y2 - y1) * self.crop_padding)
+        x1, y1 = max(0, x1 - pad_x), max(0, y1 - pad_y)
+        x2, y2 = min(width, x2 + pad_x), min(height, y2 + pad_y)
+        return frame_array[y1:y2, x1:x2]
+    
+    def submit(self, frame_array, detections):
+        """Encolar detecciones para verificar. None si se supera la tasa o la cola está llena
+
+        Si hay menos tokens que detecciones se verifican sólo las de mayor confianza.
+        """
+        detections = sorted(detections, key=lambda det: -det['confidence'])[:self.batch_size]
+        granted = self.take_tokens(len(detections))
+        if not granted:
+            self.count('rate_limited')
+            return None
+        detections = detections[:granted]
+        
+        future = Future()
+        try:
+            self.queue.put_nowait((frame_array, detections, future))
+        except queue.Full:
+            self.count('rate_limited')
+            return None
+        self.count('submitted', len(detections))
+        return future
+    
+    def verify_batch(self, items):
+        """Ejecutar el modelo pesado sobre todos los recortes del lote de una vez"""
+        crops = []
+        owners = []
+        for item_index, (frame_array, detections, _) in enumerate(items):
+            for detection in detections:
+                crops.append(self.crop(frame_array, detection))
+                owners.append((item_index, detection))
+        
+        results = self.model(crops, classes=list(self.class_ids.values()), conf=self.conf, imgsz=self.imgsz)
+        
+        confirmed = [[] for _ in items]
+        for (item_index, detection), result in zip(owners, results):
+            expected = self.class_ids.get(detection['class'])
+            best = 0.0
+            if result.boxes is not None:
+                for box in result.boxes:
+                    if int(box.cls[0].cpu().numpy()) == expected:
+                        best = max(best, float(box.conf[0].cpu().numpy()))
+            if best > 0:
+                confirmed[item_index].append({**detection, 'verified_confidence': best})
+                self.count('confirmed')
+            else:
+                self.count('rejected')
+        return confirmed
+    
+    def worker_loop(self):
+        while self.running:
+            try:
+                items = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+            
+            crop_count = len(items[0][1])
+            deadline = time.time() + self.batch_wait
+            while crop_count < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                items.append(item)
+                crop_count += len(item[1])
+            
+            try:
+                confirmed = self.verify_batch(items)
+            except Exception as e:
+                print(f"Error en verificación: {e}")
+                confirmed = [[] for _ in items]
+            for (_, _, future), result in zip(items, confirmed):
+                future.set_result(result)
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.worker_loop, name='verificacion', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=2)
+        print(f"Verificación: {self.stats['submitted']} recortes, {self.stats['confirmed']} confirmados, "
+              f"{self.stats['rejected']} rechazados, {self.stats['rate_limited']} limitados por tasa")
+
 class RTSPViewer:
     def __init__(self):
         # Configuración desde .env
@@ -86,10 +1821,22 @@ class RTSPViewer:
         self.video_windows = {}
         self.tk_root = None
         
-        # Configuración YOLO
-        self.model = YOLO('yolov8n.pt')
+        # Configuración YOLO (el modelo se carga en segundo plano al iniciar)
+        self.startup = StartupTimer()
+        self.startup.record('imports', time.time() - PROCESS_START)
+        self.model_path = os.getenv('MODEL_PATH', 'yolov8n.pt')
+        self.model = None
+        self.model_ready = threading.Event()
+        self.model_thread = None
+        
+        # Cascada opcional: CASCADE_MODEL confirma con un modelo más pesado antes de grabar
+        self.cascade_model_path = os.getenv('CASCADE_MODEL', '')
+        self.cascade_hold = float(os.getenv('CASCADE_HOLD', '5'))
+        self.verifier = None
+        self.confirmed_until = {}
         self.target_classes = [0, 2, 7, 16]  # personas, carros, camiones, perros
         self.class_names = {0: 'person', 2: 'car', 7: 'truck', 16: 'dog'}
+        self.model_imgsz = int(os.getenv('MODEL_IMGSZ', '640'))
         
         # Configuración grabación
         self.recording_buffer = 5  # segundos
@@ -99,8 +1846,74 @@ class RTSPViewer:
         self.frame_height = 480
         self.frame_rate = 30
         
+        # Publicación de eventos (EVENT_SINKS=webhook:URL,unix:RUTA,jsonl:RUTA)
+        self.event_publisher = EventPublisher.from_config(
+            os.getenv('EVENT_SINKS', ''),
+            queue_size=int(os.getenv('EVENT_QUEUE_SIZE', '1000')),
+            batch_size=int(os.getenv('EVENT_BATCH_SIZE', '50')),
+            batch_interval=float(os.getenv('EVENT_BATCH_INTERVAL', '0.5'))
+        )
+        
+        # Restream HTTP (RESTREAM_PORT=0 lo desactiva). Sin autenticación: por defecto sólo
+        # escucha en localhost; RESTREAM_HOST=0.0.0.0 lo expone explícitamente en todas las interfaces
+        self.restream_port = int(os.getenv('RESTREAM_PORT', '0'))
+        self.restream = None
+        
+        # Almacenamiento de grabaciones (tamaños en GB, 0 = sin límite; CAMERA_QUOTA_GB_<PUERTO>)
+        gb = 1024**3
+        camera_quotas = {}
+        for key, value in os.environ.items():
+            if key.startswith('CAMERA_QUOTA_GB_') and key[len('CAMERA_QUOTA_GB_'):].isdigit():
+                camera_quotas[int(key[len('CAMERA_QUOTA_GB_'):])] = int(float(value) * gb)
+        self.store = RecordingStore(
+            root=os.getenv('RECORDINGS_DIR', 'recordings'),
+            spool_dir=os.getenv('SPOOL_DIR') or None,
+            budget_bytes=int(float(os.getenv('STORAGE_BUDGET_GB', '0')) * gb),
+            camera_quota_bytes=int(float(os.getenv('CAMERA_QUOTA_GB', '0')) * gb),
+            camera_quotas=camera_quotas,
+            min_free_bytes=int(float(os.getenv('MIN_FREE_GB', '0')) * gb),
+            priority_classes=[c.strip() for c in os.getenv('PRIORITY_CLASSES', 'person').split(',') if c.strip()],
+            priority_retention=float(os.getenv('PRIORITY_RETENTION_HOURS', '72')) * 3600,
+            evict_interval=float(os.getenv('EVICT_INTERVAL', '60')),
+            free_space_ttl=float(os.getenv('FREE_SPACE_CACHE_SECONDS', '10'))
+        )
+        
+        # Miniaturas de clips (THUMBNAIL_FORMAT=jpeg|webp)
+        self.thumbnail_format = os.getenv('THUMBNAIL_FORMAT', 'jpeg').lower()
+        self.thumbnail_width = int(os.getenv('THUMBNAIL_WIDTH', '320'))
+        self.sprite_frames = int(os.getenv('SPRITE_FRAMES', '8'))
+        self.sprite_tile_width = int(os.getenv('SPRITE_TILE_WIDTH', '160'))
+        self.save_threads = []
+        self.save_threads_lock = threading.Lock()
+        
+        # Perfilado bajo demanda (SIGUSR1 o GET /profile en el servidor de restream)
+        self.profiler = SamplingProfiler(
+            output_dir=os.getenv('PROFILE_DIR', 'profiles'),
+            interval=float(os.getenv('PROFILE_INTERVAL', '0.01')),
+            default_seconds=float(os.getenv('PROFILE_SECONDS', '10'))
+        )
+        
+        # Relay RTSP local: una sola sesión por cámara (RTSP_RELAY=true)
+        self.relay_enabled = os.getenv('RTSP_RELAY', 'false').lower() == 'true'
+        self.relay_base_port = int(os.getenv('RTSP_RELAY_BASE_PORT', '8600'))
+        self.relay_idle_timeout = float(os.getenv('RTSP_RELAY_IDLE', '30'))
+        self.relay_client_queue = int(os.getenv('RTSP_RELAY_CLIENT_QUEUE', '2000'))
+        self.relays = {}
+        
+        # Zonas por cámara (clave: puerto). ROI_<PUERTO> y EXCLUDE_<PUERTO>.
+        # YOLO corre sólo sobre la caja envolvente de la ROI, a su tamaño nativo (múltiplo de 32,
+        # máximo MODEL_IMGSZ): menos píxeles que el frame completo, misma resolución por objeto
+        self.zone_filters = {}
+        for port in self.ports:
+            roi = ZoneFilter.parse_polygons(os.getenv(f'ROI_{port}', ''))
+            exclusions = ZoneFilter.parse_polygons(os.getenv(f'EXCLUDE_{port}', ''))
+            if roi or exclusions:
+                self.zone_filters[port] = ZoneFilter(roi, exclusions, self.frame_width, self.frame_height)
+        
     def create_rtsp_url(self, port):
-        """Crear URL RTSP con credenciales"""
+        """Crear URL RTSP con credenciales (o la URL local del relay si está activo)"""
+        if port in self.relays:
+            return self.relays[port].local_url(self.rtsp_path)
         if self.username and self.password:
             return f"rtsp://{self.username}:{self.password}@{self.ip}:{port}{self.rtsp_path}"
         return f"rtsp://{self.ip}:{port}{self.rtsp_path}"
@@ -108,9 +1921,7 @@ class RTSPViewer:
     def get_recording_path(self):
         """Crear directorio y nombre de archivo para grabación"""
         now = datetime.now()
-        date_path = now.strftime("%Y/%m/%d")
-        full_path = f"recordings/{date_path}"
-        os.makedirs(full_path, exist_ok=True)
+        full_path = self.store.make_clip_dir(now)
         
         date_str = now.strftime("%d%m%Y%H%M%S")
         uid = str(uuid.uuid4()).replace('-', '')[:10]
@@ -127,15 +1938,98 @@ class RTSPViewer:
             print(f"Error convirtiendo frame: {e}")
             return None
     
-    def detect_objects(self, frame_array):
-        """Detectar objetos con YOLO"""
-        results = self.model(frame_array, classes=self.target_classes, conf=0.6)
+    def use_gui(self):
+        return self.show_window and not self.vps_mode
+    
+    def load_model(self):
+        """Cargar y precalentar YOLO (se ejecuta en paralelo al sondeo de cámaras)"""
+        try:
+            with self.startup.phase('model_import'):
+                from ultralytics import YOLO
+            with self.startup.phase('model_load'):
+                self.model = YOLO(self.model_path)
+            with self.startup.phase('model_warmup'):
+                warmup_frame = np.zeros((self.frame_height, self.frame_width, 3), dtype=np.uint8)
+                self.model(warmup_frame, classes=self.target_classes, conf=0.6, imgsz=self.model_imgsz)
+            if self.cascade_model_path:
+                try:
+                    with self.startup.phase('cascade_load'):
+                        self.load_verifier(YOLO)
+                except Exception as e:
+                    print(f"✗ Error cargando modelo de verificación {self.cascade_model_path}: {e}")
+                    print("Continuando sin cascada de verificación")
+                    self.verifier = None
+            self.model_ready.set()
+        except Exception as e:
+            print(f"✗ Error cargando modelo {self.model_path}: {e}")
+            self.running = False
+    
+    def load_verifier(self, yolo_class):
+        """Cargar el modelo de verificación y arrancar su hilo de lotes"""
+        imgsz = int(os.getenv('CASCADE_IMGSZ', '320'))
+        model = yolo_class(self.cascade_model_path)
+        model(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), imgsz=imgsz)
+        
+        self.verifier = DetectionVerifier(
+            model, self.class_names,
+            conf=float(os.getenv('CASCADE_CONF', '0.5')),
+            imgsz=imgsz,
+            batch_size=int(os.getenv('CASCADE_BATCH', '8')),
+            batch_wait=float(os.getenv('CASCADE_BATCH_WAIT', '0.05')),
+            max_per_second=float(os.getenv('CASCADE_MAX_PER_SEC', '4'))
+        )
+        self.verifier.start()
+    
+    def verify_detections(self, camera_index, frame_array, detections):
+        """Confirmar con el modelo pesado; tras confirmar, el evento no se vuelve a verificar"""
+        now = time.time()
+        if now < self.confirmed_until.get(camera_index, 0):
+            self.confirmed_until[camera_index] = now + self.cascade_hold
+            return detections
+        
+        future = self.verifier.submit(frame_array, detections)
+        if future is None:
+            return []
+        try:
+            confirmed = future.result(timeout=5)
+        except Exception:
+            return []
+        
+        if confirmed:
+            self.confirmed_until[camera_index] = time.time() + self.cascade_hold
+        return confirmed
+    
+    def start_model_loading(self):
+        self.model_thread = threading.Thread(target=self.load_model, daemon=True)
+        self.model_thread.start()
+    
+    def render_frame(self, frame_data, detections):
+        """Frame crudo con detecciones dibujadas, como imagen PIL"""
+        with self.profiler.stage('restream_render'):
+            frame_array = self.frame_to_numpy(frame_data)
+            if detections:
+                frame_array = self.draw_detections(frame_array, detections)
+            return Image.fromarray(frame_array)
+    
+    def detect_objects(self, frame_array, port=None):
+        """Detectar objetos con YOLO (sólo en la ROI de la cámara si está configurada)"""
+        zone_filter = self.zone_filters.get(port)
+        offset_x, offset_y = 0, 0
+        imgsz = self.model_imgsz
+        if zone_filter:
+            # El recorte se infiere a su tamaño nativo (sin reescalar hacia arriba) para reducir coste
+            frame_array, offset_x, offset_y = zone_filter.crop(frame_array)
+            imgsz = zone_filter.inference_size(self.model_imgsz)
+        
+        results = self.model(frame_array, classes=self.target_classes, conf=0.6, imgsz=imgsz)
         detections = []
         
         for result in results:
             if result.boxes is not None:
                 for box in result.boxes:
                     x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
+                    x1, x2 = x1 + offset_x, x2 + offset_x
+                    y1, y2 = y1 + offset_y, y2 + offset_y
                     conf = box.conf[0].cpu().numpy()
                     cls = int(box.cls[0].cpu().numpy())
                     
@@ -147,6 +2041,9 @@ class RTSPViewer:
                             'center': [int((x1+x2)//2), int((y1+y2)//2)]  # Convertir explícitamente a int nativo de Python
                         })
         
+        if zone_filter:
+            detections = [det for det in detections if zone_filter.accepts(det)]
+        
         return detections
     
     def draw_detections(self, frame_array, detections):
@@ -181,11 +2078,59 @@ class RTSPViewer:
                         return True
         return False
     
-    def save_recording(self, temp_file, detections_log, camera_index):
+    def save_thumbnails(self, clip_frames, path, stem):
+        """Guardar miniatura de la mejor detección y sprite de fotogramas clave"""
+        extension = 'webp' if self.thumbnail_format == 'webp' else 'jpg'
+        image_format = 'WEBP' if extension == 'webp' else 'JPEG'
+        thumbnails = {}
+        
+        thumb_height = self.thumbnail_width * self.frame_height // self.frame_width
+        if clip_frames.best_frame is not None:
+            best = self.draw_detections(clip_frames.best_frame, clip_frames.best_detections)
+            image = Image.fromarray(best).resize((self.thumbnail_width, thumb_height), Image.Resampling.BILINEAR)
+            best_name = f"{stem}_best.{extension}"
+            image.save(f"{path}/{best_name}", format=image_format, quality=80)
+            thumbnails['best_frame'] = best_name
+            thumbnails['best_confidence'] = float(clip_frames.best_confidence)
+        
+        frames = clip_frames.sprite_frames()
+        if frames:
+            tile_width = self.sprite_tile_width
+            tile_height = tile_width * self.frame_height // self.frame_width
+            sprite = Image.new('RGB', (tile_width * len(frames), tile_height))
+            for i, frame_data in enumerate(frames):
+                tile = Image.frombytes('RGB', (self.frame_width, self.frame_height), frame_data)
+                sprite.paste(tile.resize((tile_width, tile_height), Image.Resampling.BILINEAR), (i * tile_width, 0))
+            sprite_name = f"{stem}_sprite.{extension}"
+            sprite.save(f"{path}/{sprite_name}", format=image_format, quality=75)
+            thumbnails['sprite'] = sprite_name
+            thumbnails['sprite_frames'] = len(frames)
+            thumbnails['sprite_tile'] = [tile_width, tile_height]
+        
+        return thumbnails
+    
+    def save_recording_async(self, temp_file, detections_log, camera_index, port, clip_frames=None):
+        """Guardar grabación en segundo plano para no bloquear la lectura de la cámara"""
+        thread = threading.Thread(
+            target=self.save_recording,
+            args=(temp_file, detections_log, camera_index, port, clip_frames),
+            daemon=True
+        )
+        with self.save_threads_lock:
+            self.save_threads = [t for t in self.save_threads if t.is_alive()]
+            self.save_threads.append(thread)
+            thread.start()
+    
+    def save_recording(self, temp_file, detections_log, camera_index, port, clip_frames=None):
         """Guardar grabación usando FFmpeg"""
         if not os.path.exists(temp_file):
             return
         
+        if not self.store.ensure_space():
+            print(f"✗ Sin espacio en disco, descartando grabación cámara {camera_index}")
+            os.remove(temp_file)
+            return
+        
         path, filename = self.get_recording_path()
         video_path = f"{path}/{filename}"
         json_path = f"{path}/{filename.replace('.mp4', '.json')}"
@@ -221,19 +2166,29 @@ class RTSPViewer:
                     }
                     clean_detections.append(clean_detection)
                 
+                thumbnails = {}
+                if clip_frames:
+                    try:
+                        thumbnails = self.save_thumbnails(clip_frames, path, filename[:-4])
+                    except Exception as e:
+                        print(f"Error generando miniaturas: {e}")
+                
                 metadata = {
                     'video_filename': filename,
                     'camera_index': int(camera_index),
+                    'port': int(port),
                     'timestamp': datetime.now().isoformat(),
                     'detections': clean_detections,
                     'total_frames': int(frame_count),
-                    'duration_seconds': float(frame_count / self.frame_rate)
+                    'duration_seconds': float(frame_count / self.frame_rate),
+                    'thumbnails': thumbnails
                 }
                 
                 with open(json_path, 'w') as f:
                     json.dump(metadata, f, indent=2)
                     
                 print(f"Metadatos guardados: {json_path}")
+                self.store.add_clip(f"{path}/{filename[:-4]}", metadata)
             else:
                 print(f"Error guardando video: {result.stderr.decode()}")
         except Exception as e:
@@ -242,15 +2197,26 @@ class RTSPViewer:
             if os.path.exists(temp_file):
                 os.remove(temp_file)
     
-    def detection_thread(self, detection_queue, result_queue, camera_index):
+    def detection_thread(self, detection_queue, result_queue, camera_index, port):
         """Hilo para procesar detecciones YOLO"""
+        # Esperar a que termine la carga del modelo
+        while self.running and not self.model_ready.wait(timeout=1):
+            continue
+        
         while self.running:
             try:
                 frame_data = detection_queue.get(timeout=1)
-                frame_array = self.frame_to_numpy(frame_data)
+                with self.profiler.stage('frame_to_numpy'):
+                    frame_array = self.frame_to_numpy(frame_data)
                 if frame_array is not None:
-                    detections = self.detect_objects(frame_array)
+                    with self.profiler.stage('yolo'):
+                        detections = self.detect_objects(frame_array, port)
+                    if self.verifier and detections:
+                        with self.profiler.stage('verificacion'):
+                            detections = self.verify_detections(camera_index, frame_array, detections)
                     result_queue.put((frame_array, detections))
+                    self.startup.milestone(f'primera_deteccion_cam{camera_index + 1}')
+                    self.startup.report()
             except queue.Empty:
                 continue
             except Exception as e:
@@ -285,7 +2251,8 @@ class RTSPViewer:
         
         detection_thread = threading.Thread(
             target=self.detection_thread,
-            args=(detection_queue, result_queue, camera_index),
+            args=(detection_queue, result_queue, camera_index, port),
+            name=f'deteccion_cam{camera_index + 1}',
             daemon=True
         )
         detection_thread.start()
@@ -299,6 +2266,9 @@ class RTSPViewer:
         detections_log = []
         temp_file = None
         temp_fd = None
+        event_id = None
+        clip_frames = None
+        overlay_detections = []
         
         frame_count = 0
         frame_size = self.frame_width * self.frame_height * 3
@@ -306,12 +2276,15 @@ class RTSPViewer:
         while self.running and process.poll() is None:
             try:
                 # Leer frame
-                frame_data = process.stdout.read(frame_size)
+                with self.profiler.stage('lectura_pipe'):
+                    frame_data = process.stdout.read(frame_size)
                 if len(frame_data) != frame_size:
                     break
                 
                 frame_buffer.append(frame_data)
                 frame_count += 1
+                if frame_count == 1:
+                    self.startup.milestone(f'primer_frame_cam{camera_index + 1}')
                 
                 # Enviar para detección cada 5 frames
                 if frame_count % 5 == 0 and detection_queue.empty():
@@ -327,9 +2300,13 @@ class RTSPViewer:
                     while not result_queue.empty():
                         frame_array, detections = result_queue.get_nowait()
                         current_detections = detections
+                        overlay_detections = detections
                 except queue.Empty:
                     pass
                 
+                if self.restream:
+                    self.restream.update(camera_index + 1, frame_data, overlay_detections)
+                
                 # Lógica de grabación
                 if current_detections:
                     # Verificar si es estático
@@ -339,10 +2316,15 @@ class RTSPViewer:
                         elif time.time() - static_start_time > self.static_threshold:
                             if recording and temp_fd:
                                 temp_fd.close()
-                                self.save_recording(temp_file, detections_log, camera_index + 1)
+                                self.event_publisher.publish('event_end', camera_index + 1, port=port,
+                                                             event_id=event_id, reason='static',
+                                                             total_detections=len(detections_log))
+                                self.save_recording_async(temp_file, detections_log, camera_index + 1, port, clip_frames)
                                 recording = False
                                 temp_file = None
                                 temp_fd = None
+                                event_id = None
+                                clip_frames = None
                                 detections_log = []
                                 print(f"Objeto estático detectado, deteniendo grabación cámara {camera_index + 1}")
                             static_start_time = 0
@@ -357,38 +2339,53 @@ class RTSPViewer:
                     if not recording:
                         recording = True
                         detections_log = []
+                        event_id = uuid.uuid4().hex
+                        self.event_publisher.publish('event_start', camera_index + 1, port=port,
+                                                     event_id=event_id, detections=current_detections)
                         
-                        temp_fd, temp_file = tempfile.mkstemp(suffix='.raw')
+                        temp_fd, temp_file = tempfile.mkstemp(suffix='.raw', dir=self.store.spool_dir)
                         temp_fd = os.fdopen(temp_fd, 'wb')
+                        clip_frames = ClipFrames(self.sprite_frames, self.frame_rate)
                         
                         # Escribir buffer
                         for buffered_frame in frame_buffer:
                             temp_fd.write(buffered_frame)
+                            clip_frames.add_frame(buffered_frame)
                         
                         print(f"Iniciando grabación cámara {camera_index + 1}")
                     
+                    self.event_publisher.publish('detection', camera_index + 1, port=port,
+                                                 event_id=event_id, detections=current_detections)
                     detections_log.extend(current_detections)
+                    clip_frames.add_detection(frame_array, current_detections)
                     previous_detections = current_detections
                 
                 # Continuar grabación
                 if recording and temp_fd:
                     temp_fd.write(frame_data)
+                    clip_frames.add_frame(frame_data)
                     
                     # Detener si no hay detecciones
                     if time.time() - last_detection_time > self.recording_buffer:
                         temp_fd.close()
-                        self.save_recording(temp_file, detections_log, camera_index + 1)
+                        self.event_publisher.publish('event_end', camera_index + 1, port=port,
+                                                     event_id=event_id, reason='timeout',
+                                                     total_detections=len(detections_log))
+                        self.save_recording_async(temp_file, detections_log, camera_index + 1, port, clip_frames)
                         recording = False
                         temp_file = None
                         temp_fd = None
+                        event_id = None
+                        clip_frames = None
                         detections_log = []
                         previous_detections = []
                         print(f"Grabación terminada cámara {camera_index + 1}")
                 
                 # Mostrar video
-                if self.show_window and not self.vps_mode and frame_array is not None:
+                if self.use_gui() and frame_array is not None:
                     if current_detections:
-                        frame_array = self.draw_detections(frame_array, current_detections)
+                        with self.profiler.stage('draw_detections'):
+                            frame_array = self.draw_detections(frame_array, current_detections)
                     
                     if camera_index in self.video_windows:
                         self.video_windows[camera_index].queue_frame(frame_array)
@@ -398,6 +2395,10 @@ class RTSPViewer:
                 break
         
         # Limpiar
+        if event_id:
+            self.event_publisher.publish('event_end', camera_index + 1, port=port,
+                                         event_id=event_id, reason='stopped',
+                                         total_detections=len(detections_log))
         if temp_fd:
             temp_fd.close()
         if temp_file and os.path.exists(temp_file):
@@ -443,6 +2444,31 @@ class RTSPViewer:
             print(f"✗ Error en puerto {port}: {e}")
             return False
 
+    def start_relays(self):
+        """Iniciar un relay local por cámara antes de sondear"""
+        for index, port in enumerate(self.ports):
+            relay = RTSPRelay(
+                f"rtsp://{self.ip}:{port}{self.rtsp_path}",
+                self.username, self.password,
+                listen_port=self.relay_base_port + index,
+                idle_timeout=self.relay_idle_timeout,
+                client_queue=self.relay_client_queue
+            )
+            try:
+                relay.start()
+                self.relays[port] = relay
+                print(f"✓ Relay puerto {port} → {relay.local_url(self.rtsp_path)}")
+            except OSError as e:
+                print(f"✗ No se pudo iniciar relay para puerto {port}: {e}")
+    
+    def probe_ports(self, ports):
+        """Probar todos los puertos en paralelo, conservando el orden"""
+        if not ports:
+            return []
+        with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+            results = list(executor.map(self.test_connection, ports))
+        return [port for port, ok in zip(ports, results) if ok]
+
     def on_closing(self):
         """Manejar cierre de ventanas"""
         self.running = False
@@ -452,22 +2478,56 @@ class RTSPViewer:
         print(f"Iniciando RTSP Viewer")
         print(f"Modo VPS: {self.vps_mode} | Mostrar ventanas: {self.show_window}")
         print(f"IP: {self.ip} | Puertos: {self.ports}")
+        for port, zone_filter in self.zone_filters.items():
+            print(f"Zonas puerto {port}: {len(zone_filter.roi_polygons)} ROI, "
+                  f"{len(zone_filter.exclusion_polygons)} exclusión, recorte {zone_filter.crop_box}")
         
-        if not self.check_dependencies():
-            return
+        with self.startup.phase('dependencias'):
+            if not self.check_dependencies():
+                return
         
-        # Probar conexiones
-        valid_ports = [port for port in self.ports if self.test_connection(port)]
+        # Cargar modelo mientras se prueban las cámaras
+        self.running = True
+        self.start_model_loading()
+        
+        if self.relay_enabled:
+            self.start_relays()
+        
+        # Probar conexiones en paralelo
+        with self.startup.phase('sondeo_camaras'):
+            valid_ports = self.probe_ports(self.ports)
         
         if not valid_ports:
             print("No se pudo conectar a ninguna cámara")
+            self.running = False
+            for relay in self.relays.values():
+                relay.stop()
             return
         
         print(f"\nIniciando streaming en {len(valid_ports)} cámara(s)...")
-        self.running = True
+        self.event_publisher.start()
+        self.store.start()
+        
+        if self.restream_port:
+            self.restream = RestreamServer(
+                self.render_frame,
+                host=os.getenv('RESTREAM_HOST', '127.0.0.1'),
+                port=self.restream_port,
+                fps=float(os.getenv('RESTREAM_FPS', '10')),
+                quality=int(os.getenv('RESTREAM_QUALITY', '75')),
+                max_clients=int(os.getenv('RESTREAM_MAX_CLIENTS', '20')),
+                profiler=self.profiler
+            )
+            for i in range(len(valid_ports)):
+                self.restream.add_camera(i + 1)
+            try:
+                self.restream.start()
+            except OSError as e:
+                print(f"✗ No se pudo iniciar restream en puerto {self.restream_port}: {e}")
+                self.restream = None
 
         # Crear ventanas si es necesario
-        if self.show_window and not self.vps_mode:
+        if self.use_gui():
             self.tk_root = tk.Tk()
             self.tk_root.withdraw()
             self.tk_root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -478,7 +2538,7 @@ class RTSPViewer:
         
         # Crear hilos para cada cámara
         for i, port in enumerate(valid_ports):
-            thread = threading.Thread(target=self.camera_thread, args=(port, i), daemon=True)
+            thread = threading.Thread(target=self.camera_thread, args=(port, i), name=f'camara{i + 1}', daemon=True)
             thread.start()
             self.threads.append(thread)
             time.sleep(1)
@@ -486,11 +2546,12 @@ class RTSPViewer:
         try:
             print("Sistema activo. Presiona Ctrl+C para salir")
             while self.running:
-                if self.show_window and not self.vps_mode and self.tk_root:
+                if self.use_gui() and self.tk_root:
                     try:
-                        for window in self.video_windows.values():
-                            window.update_from_queue()
-                        self.tk_root.update()
+                        with self.profiler.stage('tk'):
+                            for window in self.video_windows.values():
+                                window.update_from_queue()
+                            self.tk_root.update()
                         time.sleep(0.033)  # ~30 FPS
                     except tk.TclError:
                         break
@@ -512,6 +2573,24 @@ class RTSPViewer:
         
         for thread in self.threads:
             thread.join(timeout=2)
+        
+        # Esperar grabaciones pendientes (FFmpeg tiene timeout de 30s)
+        with self.save_threads_lock:
+            save_threads = list(self.save_threads)
+        for thread in save_threads:
+            thread.join(timeout=30)
+        
+        self.event_publisher.stop()
+        self.store.stop()
+        
+        if self.verifier:
+            self.verifier.stop()
+        
+        for relay in self.relays.values():
+            relay.stop()
+        
+        if self.restream:
+            self.restream.stop()
 
         for window in self.video_windows.values():
             window.close()
@@ -527,10 +2606,14 @@ class RTSPViewer:
     def check_dependencies(self):
         """Verificar dependencias"""
         try:
-            import numpy as np
-            from ultralytics import YOLO
-            from PIL import Image, ImageTk
-            import tkinter as tk
+            # find_spec no importa ultralytics; la carga real ocurre en load_model
+            missing = [name for name in ('numpy', 'ultralytics', 'PIL') if importlib.util.find_spec(name) is None]
+            if missing:
+                raise ImportError(f"No module named {', '.join(missing)}")
+            
+            # La GUI sí se importa aquí: detecta _tkinter o PIL.ImageTk ausentes antes de arrancar nada
+            if self.use_gui():
+                import_gui()
             
             result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True, timeout=5)
             if result.returncode != 0:
@@ -549,7 +2632,7 @@ class RTSPViewer:
     def list_cameras(self):
         """Listar cámaras disponibles"""
         print("Escaneando cámaras...")
-        available = [port for port in self.ports if self.test_connection(port)]
+        available = self.probe_ports(self.ports)
         
         if available:
             print(f"Cámaras disponibles: {available}")
@@ -569,6 +2652,11 @@ def main():
     
     viewer = RTSPViewer()
     
+    if hasattr(signal, 'SIGUSR1'):
+        # El manejador no toma locks del perfilador (el hilo principal puede tenerlos en la etapa 'tk')
+        viewer.profiler.start_trigger_listener()
+        signal.signal(signal.SIGUSR1, lambda sig, frame: viewer.profiler.trigger())
+    
     if len(sys.argv) > 1 and sys.argv[1] == '--list':
         viewer.list_cameras()
         return
@@ -0,0 +1,108 @@
+"""Cascada de verificación: token bucket y lotes con un modelo de prueba"""
+import time
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+pytest.importorskip('dotenv')
+
+import camaras
+
+CLASS_NAMES = {0: 'person', 2: 'car'}
+
+
+class FakeTensor:
+    def __init__(self, value):
+        self.value = value
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.value
+
+
+class FakeBox:
+    def __init__(self, cls, conf):
+        self.cls = [FakeTensor(cls)]
+        self.conf = [FakeTensor(conf)]
+
+
+class FakeResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class FakeModel:
+    """Confirma siempre como 'car' y registra el tamaño de cada lote"""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, crops, **kwargs):
+        self.batches.append(len(crops))
+        return [FakeResult([FakeBox(2, 0.9)]) for _ in crops]
+
+
+class FakeFrame:
+    """Frame mínimo: sólo lo que usa DetectionVerifier.crop"""
+    shape = (480, 640, 3)
+
+    def __getitem__(self, key):
+        return self
+
+
+def detection(cls, confidence):
+    return {'class': cls, 'confidence': confidence, 'bbox': [10, 10, 50, 50], 'center': [30, 30]}
+
+
+def make_verifier(max_per_second, **kwargs):
+    verifier = camaras.DetectionVerifier(FakeModel(), CLASS_NAMES, max_per_second=max_per_second, **kwargs)
+    verifier.last_refill = time.time()
+    return verifier
+
+
+def test_partial_grant_keeps_highest_confidence_crops():
+    verifier = make_verifier(max_per_second=2)
+    detections = [detection('car', conf) for conf in (0.61, 0.95, 0.7, 0.88, 0.65)]
+
+    future = verifier.submit(FakeFrame(), detections)
+
+    assert future is not None
+    _, queued, _ = verifier.queue.get_nowait()
+    assert [det['confidence'] for det in queued] == [0.95, 0.88]
+    assert verifier.stats['submitted'] == 2
+    assert verifier.stats['rate_limited'] == 0
+
+
+def test_empty_bucket_returns_none_and_counts_rate_limited():
+    verifier = make_verifier(max_per_second=2)
+    frame = FakeFrame()
+
+    assert verifier.submit(frame, [detection('car', 0.9)] * 2) is not None
+    assert verifier.submit(frame, [detection('car', 0.9)]) is None
+    assert verifier.stats['rate_limited'] == 1
+
+
+def test_bucket_always_allows_one_crop():
+    verifier = make_verifier(max_per_second=0.5)
+
+    assert verifier.submit(FakeFrame(), [detection('car', 0.9)] * 3) is not None
+    assert verifier.stats['submitted'] == 1
+
+
+def test_batch_confirms_only_matching_class():
+    verifier = make_verifier(max_per_second=10, batch_wait=0.2)
+    verifier.start()
+    try:
+        frame = FakeFrame()
+        futures = [verifier.submit(frame, [detection('car', 0.8), detection('person', 0.7)]) for _ in range(2)]
+        results = [future.result(timeout=5) for future in futures]
+    finally:
+        verifier.stop()
+
+    assert verifier.model.batches == [4]
+    for confirmed in results:
+        assert [det['class'] for det in confirmed] == ['car']
+        assert confirmed[0]['verified_confidence'] == 0.9
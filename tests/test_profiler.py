@@ -0,0 +1,56 @@
+"""Perfilador: etapas concurrentes en varios hilos generan todos los archivos"""
+import cProfile
+import glob
+import io
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+pytest.importorskip('dotenv')
+
+import camaras
+
+
+def busy(profiler, stage, stop):
+    while not stop.is_set():
+        with profiler.stage(stage):
+            sum(i * i for i in range(2000))
+
+
+@pytest.mark.parametrize('use_cprofile', [None, False])
+def test_concurrent_stages_write_every_file(tmp_path, use_cprofile):
+    profiler = camaras.SamplingProfiler(str(tmp_path), interval=0.005, default_seconds=0.5,
+                                        use_cprofile=use_cprofile)
+    stop = threading.Event()
+    workers = [threading.Thread(target=busy, args=(profiler, stage, stop))
+               for stage in ('lectura_pipe', 'lectura_pipe', 'yolo')]
+
+    assert profiler.start()
+    for worker in workers:
+        worker.start()
+    profiler.sample_thread.join(timeout=10)
+    stop.set()
+    for worker in workers:
+        worker.join(timeout=5)
+
+    names = [os.path.basename(path) for path in glob.glob(str(tmp_path / 'profile_*'))]
+    for suffix in ('.collapsed', '_etapas.txt', '_lectura_pipe.txt', '_yolo.txt'):
+        assert any(name.endswith(suffix) for name in names), (suffix, names)
+
+    yolo_summary = glob.glob(str(tmp_path / 'profile_*_yolo.txt'))[0]
+    with open(yolo_summary) as f:
+        assert f.read().strip()
+
+
+def test_empty_profiles_fall_back_to_samples():
+    profiler = camaras.SamplingProfiler(use_cprofile=True)
+    profiler.stage_stacks = {'yolo': {'deteccion;run (x.py:1);detect (x.py:2)': 3}}
+    output = io.StringIO()
+
+    assert not profiler.write_cprofile_summary(output, [cProfile.Profile()])
+    profiler.write_sample_summary(output, 'yolo')
+    assert 'detect (x.py:2)' in output.getvalue()
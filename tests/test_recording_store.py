@@ -0,0 +1,112 @@
+"""Retención de grabaciones: presupuesto, cuotas por puerto, prioridad y limpieza de directorios"""
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+pytest.importorskip('dotenv')
+
+import camaras
+
+CLIP_SIZE = 1000
+
+
+def write_clip(root, date_path, name, mtime, port=None, classes=('car',)):
+    """Crear un clip falso (mp4 + json) con la fecha de modificación indicada"""
+    directory = os.path.join(root, date_path)
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, name)
+
+    with open(f"{stem}.mp4", 'wb') as f:
+        f.write(b'x' * CLIP_SIZE)
+    metadata = {'camera_index': 1, 'detections': [{'class': cls} for cls in classes]}
+    if port is not None:
+        metadata['port'] = port
+    with open(f"{stem}.json", 'w') as f:
+        json.dump(metadata, f)
+
+    for path in (f"{stem}.mp4", f"{stem}.json"):
+        os.utime(path, (mtime, mtime))
+    return stem
+
+
+def make_store(tmp_path, **kwargs):
+    store = camaras.RecordingStore(root=str(tmp_path / 'recs'), spool_dir=str(tmp_path / 'spool'), **kwargs)
+    return store
+
+
+def remaining(store):
+    return sorted(os.path.basename(stem) for stem in store.clips)
+
+
+def test_budget_evicts_oldest_first(tmp_path):
+    store = make_store(tmp_path, budget_bytes=int(CLIP_SIZE * 2.5))
+    for i in range(4):
+        write_clip(store.root, '2024/01/01', f'clip{i}', 1000 + i, port=554)
+    store.scan()
+    store.evict()
+
+    assert remaining(store) == ['clip2', 'clip3']
+
+
+def test_priority_classes_are_evicted_last(tmp_path):
+    store = make_store(tmp_path, budget_bytes=int(CLIP_SIZE * 2.5),
+                       priority_classes=['person'], priority_retention=10**12)
+    write_clip(store.root, '2024/01/01', 'person_old', 1000, port=554, classes=('person',))
+    write_clip(store.root, '2024/01/01', 'car_old', 1001, port=554)
+    write_clip(store.root, '2024/01/01', 'car_new', 1002, port=554)
+    write_clip(store.root, '2024/01/01', 'car_newest', 1003, port=554)
+    store.scan()
+    store.evict()
+
+    assert remaining(store) == ['car_newest', 'person_old']
+
+
+def test_quota_is_per_port_and_skips_clips_without_port(tmp_path):
+    store = make_store(tmp_path, camera_quotas={554: int(CLIP_SIZE * 1.5)})
+    write_clip(store.root, '2024/01/01', 'a554_old', 1000, port=554)
+    write_clip(store.root, '2024/01/01', 'a554_new', 1003, port=554)
+    write_clip(store.root, '2024/01/01', 'b555_old', 999, port=555)
+    write_clip(store.root, '2024/01/01', 'legacy1', 998)
+    write_clip(store.root, '2024/01/01', 'legacy2', 997)
+    store.scan()
+    store.evict()
+
+    assert remaining(store) == ['a554_new', 'b555_old', 'legacy1', 'legacy2']
+
+
+def test_min_free_is_opt_in(tmp_path):
+    store = make_store(tmp_path)
+    write_clip(store.root, '2024/01/01', 'clip0', 1000, port=554)
+    store.scan()
+
+    assert store.ensure_space()
+    store.evict()
+    assert remaining(store) == ['clip0']
+
+
+def test_pruning_stops_at_root_and_keeps_today(tmp_path):
+    store = make_store(tmp_path, budget_bytes=1)
+    old = write_clip(store.root, '2024/01/01', 'old', 1000, port=554)
+    today_dir = store.make_clip_dir(datetime.now())
+    today = write_clip(store.root, os.path.relpath(today_dir, store.root), 'today', 1001, port=554)
+    store.scan()
+    store.evict()
+
+    assert remaining(store) == []
+    assert not os.path.exists(os.path.dirname(old))
+    assert not os.path.exists(os.path.join(store.root, '2024'))
+    assert os.path.isdir(os.path.dirname(today))
+    assert os.path.isdir(store.root)
+    assert os.path.isdir(str(tmp_path))
+
+
+def test_evict_waits_for_scan(tmp_path):
+    store = make_store(tmp_path, budget_bytes=1)
+    write_clip(store.root, '2024/01/01', 'clip0', 1000, port=554)
+    store.evict()
+
+    assert os.path.exists(os.path.join(store.root, '2024/01/01/clip0.mp4'))
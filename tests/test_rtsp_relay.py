@@ -0,0 +1,212 @@
+"""Relay RTSP contra un servidor RTSP local de prueba (sin cámara real)"""
+import hashlib
+import re
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+pytest.importorskip('dotenv')
+
+import camaras
+
+USERNAME = 'admin'
+PASSWORD = 'secret'
+REALM = 'camara'
+NONCE = 'abc123'
+RTSP_PATH = '/cam/realmonitor?channel=1&subtype=0'
+SDP = (
+    "v=0\r\n"
+    "o=- 0 0 IN IP4 127.0.0.1\r\n"
+    "s=Camara de prueba\r\n"
+    "t=0 0\r\n"
+    "a=control:*\r\n"
+    "m=video 0 RTP/AVP 96\r\n"
+    "a=rtpmap:96 H264/90000\r\n"
+    "a=control:trackID=0\r\n"
+)
+
+
+class StandInRTSPServer:
+    """Servidor RTSP mínimo: Digest, DESCRIBE/SETUP/PLAY y RTP intercalado por TCP"""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self.sessions = 0
+        self.running = True
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def check_digest(self, method, authorization):
+        params = dict(re.findall(r'(\w+)="?([^",]*)"?', authorization[len('Digest '):]))
+        ha1 = hashlib.md5(f"{USERNAME}:{REALM}:{PASSWORD}".encode()).hexdigest()
+        ha2 = hashlib.md5(f"{method}:{params['uri']}".encode()).hexdigest()
+        return params['response'] == hashlib.md5(f"{ha1}:{NONCE}:{ha2}".encode()).hexdigest()
+
+    def handle(self, conn):
+        reader = conn.makefile('rb')
+        while self.running:
+            request_line = reader.readline().decode().strip()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = reader.readline().decode().strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            method, uri, _ = request_line.split(' ')
+            cseq = headers['cseq']
+            authorization = headers.get('authorization', '')
+            if not authorization.startswith('Digest ') or not self.check_digest(method, authorization):
+                conn.sendall(f'RTSP/1.0 401 Unauthorized\r\nCSeq: {cseq}\r\n'
+                             f'WWW-Authenticate: Digest realm="{REALM}", nonce="{NONCE}"\r\n\r\n'.encode())
+                continue
+
+            extra = ''
+            body = ''
+            if method == 'DESCRIBE':
+                body = SDP
+                extra = f'Content-Base: {uri}/\r\nContent-Type: application/sdp\r\n'
+            elif method == 'SETUP':
+                assert uri.endswith('/trackID=0')
+                self.sessions += 1
+                extra = f'Session: S{self.sessions};timeout=60\r\nTransport: {headers["transport"]}\r\n'
+            conn.sendall(f'RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\n{extra}'
+                         f'Content-Length: {len(body)}\r\n\r\n{body}'.encode())
+
+            if method == 'PLAY':
+                threading.Thread(target=self.pump, args=(conn,), daemon=True).start()
+            elif method == 'TEARDOWN':
+                break
+
+    def pump(self, conn):
+        """Enviar RTP (canal 0) y RTCP (canal 1) alternados con número de secuencia"""
+        sequence = 0
+        try:
+            while self.running:
+                sequence += 1
+                for channel in (0, 1):
+                    payload = struct.pack('>I', sequence)
+                    conn.sendall(b'$' + bytes([channel]) + struct.pack('>H', len(payload)) + payload)
+                time.sleep(0.002)
+        except OSError:
+            pass
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+
+
+class RTSPTestClient:
+    """Cliente RTSP mínimo que pide transporte intercalado en canales propios"""
+
+    def __init__(self, url, rtp_channel):
+        match = re.match(r'^rtsp://([^/:]+):(\d+)', url)
+        self.url = url
+        self.rtp_channel = rtp_channel
+        self.sock = socket.create_connection((match.group(1), int(match.group(2))), timeout=5)
+        self.reader = self.sock.makefile('rb')
+        self.cseq = 0
+
+    def request(self, method, uri, headers=None):
+        self.cseq += 1
+        lines = [f"{method} {uri} RTSP/1.0", f"CSeq: {self.cseq}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        self.sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode())
+
+        status_line = self.reader.readline().decode().strip()
+        response_headers = {}
+        while True:
+            line = self.reader.readline().decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        body = self.reader.read(int(response_headers.get('content-length', 0)))
+        return int(status_line.split(' ')[1]), response_headers, body
+
+    def play(self):
+        status, headers, sdp = self.request('DESCRIBE', self.url, {'Accept': 'application/sdp'})
+        assert status == 200
+        assert b'a=control:track0' in sdp
+
+        transport = f"RTP/AVP/TCP;unicast;interleaved={self.rtp_channel}-{self.rtp_channel + 1}"
+        status, setup_headers, _ = self.request('SETUP', headers['content-base'] + 'track0', {'Transport': transport})
+        assert status == 200
+        assert f"interleaved={self.rtp_channel}-{self.rtp_channel + 1}" in setup_headers['transport']
+
+        session = setup_headers['session'].split(';')[0]
+        status, _, _ = self.request('PLAY', self.url, {'Session': session})
+        assert status == 200
+
+    def read_packets(self, count):
+        packets = []
+        while len(packets) < count:
+            header = self.reader.read(4)
+            assert header[:1] == b'$'
+            payload = self.reader.read(struct.unpack('>H', header[2:4])[0])
+            packets.append((header[1], struct.unpack('>I', payload)[0]))
+        return packets
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def camera():
+    server = StandInRTSPServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def relay(camera):
+    relay = camaras.RTSPRelay(f"rtsp://127.0.0.1:{camera.port}{RTSP_PATH}", USERNAME, PASSWORD, listen_port=0)
+    relay.start()
+    yield relay
+    relay.stop()
+
+
+def test_relay_fans_out_one_upstream_session_with_channel_remapping(camera, relay):
+    clients = [RTSPTestClient(relay.local_url(RTSP_PATH), rtp_channel) for rtp_channel in (0, 4)]
+    packets = {}
+
+    def receive(client):
+        client.play()
+        packets[client.rtp_channel] = client.read_packets(40)
+
+    threads = [threading.Thread(target=receive, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    for client in clients:
+        received = packets[client.rtp_channel]
+        assert len(received) == 40
+        # RTP de la cámara (canal 0) y RTCP (canal 1) llegan en los canales pedidos por el cliente
+        assert {channel for channel, _ in received} == {client.rtp_channel, client.rtp_channel + 1}
+        rtp_sequences = [sequence for channel, sequence in received if channel == client.rtp_channel]
+        assert rtp_sequences == sorted(rtp_sequences)
+        client.close()
+
+    assert camera.sessions == 1
+    assert relay.sessions_opened == 1